@@ -1,16 +1,196 @@
+import heapq
 import os
+import stat
 import sys
 import logging
 from collections import defaultdict
-from gitignore_parser import parse_gitignore
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import pathspec
 import tiktoken
-from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Buffer size for the combined output stream
+WRITE_BUFFER = 1 << 20
+# Files below this size get an estimated token count when approx_small_files is enabled
+SMALL_FILE_BYTES = 256
+# Approximate bytes of file contents read and tokenized together during token counting
+READ_BATCH_BYTES = 32 * 1024 * 1024
+
+SEPARATOR = b"================================================================\n"
+FILE_SEPARATOR = b"================\n"
+HEADER_INTRO = (
+    b"****** DOCUMENT INTRODUCTION ******\n\n"
+    b"This file is a merged representation of the codebase, combining selected repository files into a single document.\n"
+    b"Files ignored by .gitignore, specific skip rules (directories, filenames, special cases), or file type filters are excluded.\n"
+    b"\n" + SEPARATOR +
+    b"File Summary\n" +
+    SEPARATOR + b"\n"
+    b"Purpose:\n--------\n"
+    b"This file contains a packed representation of the repository's relevant contents.\n"
+    b"It is designed to be easily consumable by AI systems for analysis, code review,\n"
+    b"or other automated processes.\n\n"
+    b"File Format:\n------------\n"
+    b"The content is organized as follows:\n"
+    b"1. This summary section\n"
+    b"2. Repository metrics (based on included files)\n"
+    b"3. Repository structure (visual tree with token counts, respecting ignores/skips)\n"
+    b"4. Multiple file entries, each consisting of:\n"
+    b"  a. A separator line (================)\n"
+    b"  b. The file path relative to the root (File: path/to/file)\n"
+    b"  c. Another separator line\n"
+    b"  d. The full contents of the file\n"
+    b"  e. A blank line\n\n"
+)
+HEADER_METRICS = b"\n" + SEPARATOR + b"Repository Metrics (Included Files)\n" + SEPARATOR + b"\n"
+HEADER_STRUCTURE = b"\n" + SEPARATOR + b"Repository Structure (Filtered, with Token Counts)\n" + SEPARATOR + b"\n"
+HEADER_FILES = b"\n" + SEPARATOR + b"Repository Files Content\n" + SEPARATOR + b"\n"
+
+# Separator fix-up for displayed paths; None on POSIX, where paths already use '/'
+_PATH_FIXUP = None if os.sep == '/' else str.maketrans({os.sep: '/'})
+
+
+def _to_unix_path(path):
+    """
+    Returns path with '/' separators, without allocating on POSIX.
+    """
+    return path if _PATH_FIXUP is None else path.translate(_PATH_FIXUP)
+
+
+def _file_extension(file_name):
+    """
+    Returns the extension used to group files in the metrics: the same as
+    os.path.splitext(file_name)[-1], or the whole name when there is none.
+    """
+    dot = file_name.rfind('.')
+    # Like splitext, leading dots do not start an extension
+    if dot > 0 and file_name[:dot].lstrip('.'):
+        return file_name[dot:]
+    return file_name
+
+
+def _load_gitignore(gitignore_path):
+    """
+    Compiles a .gitignore file into a matcher for absolute paths.
+    Paths are matched relative to the directory containing the .gitignore; a
+    trailing separator marks a directory. Paths outside that directory are
+    never ignored.
+    """
+    with open(gitignore_path, 'r', encoding='utf-8') as f:
+        spec = pathspec.GitIgnoreSpec.from_lines(f)
+    base_prefix = os.path.join(os.path.dirname(os.path.abspath(gitignore_path)), '')
+
+    def is_ignored(path):
+        # Walk paths are already absolute and normalized, so a prefix slice gives the relative path
+        if not path.startswith(base_prefix):
+            return False
+        return spec.match_file(path[len(base_prefix):])
+
+    return is_ignored
+
+
+def _estimate_tokens(size):
+    """
+    Estimates the token count of a small file from its size (~4 bytes per token).
+    """
+    return max(1, size // 4) if size else 0
+
+
+@lru_cache(maxsize=4)
+def _get_encoding(name):
+    """
+    Returns the tiktoken encoding, loading its BPE table only once per process.
+    """
+    return tiktoken.get_encoding(name)
+
+
+def _read_file_contents(file_path, display_path):
+    """
+    Reads a file once and returns (text, content).
+    text is decoded as UTF-8, falling back to latin-1, and is what gets tokenized.
+    content is the UTF-8 bytes written to the output (see _output_bytes). For valid
+    UTF-8 files without carriage returns it is the raw bytes, with no re-encoding.
+    Returns (None, None) if the file cannot be read.
+    display_path is the path used in log messages.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            raw = f.read()
+    except FileNotFoundError:
+         logger.error("File not found during token counting: %s", display_path)
+         return None, None
+    except Exception as e:
+        logger.error("Error reading file %s for token counting: %s", display_path, e)
+        return None, None
+    try:
+        text = raw.decode("utf-8")
+    except UnicodeDecodeError:
+        # Fallback encoding (latin-1 decodes any byte sequence)
+        logger.warning("Encoding error (UTF-8) in file %s, read with latin-1.", display_path)
+        return _translate_newlines(raw.decode("latin-1")), _output_bytes(raw)
+    if "\r" not in text:
+        return text, raw
+    text = _translate_newlines(text)
+    return text, text.encode("utf-8")
+
+
+def _output_bytes(raw):
+    """
+    Converts raw file bytes to the form written to the output: UTF-8 with
+    undecodable bytes replaced and universal newlines applied.
+    """
+    return _translate_newlines(raw.decode("utf-8", errors="replace")).encode("utf-8")
+
+
+def _translate_newlines(text):
+    """
+    Applies text-mode universal newline handling (\\r\\n and \\r become \\n).
+    """
+    if "\r" in text:
+        return text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+def _size_batches(sizes, limit):
+    """
+    Splits consecutive file sizes into (start, end) index ranges of about limit bytes.
+    Every range holds at least one file, so a file larger than limit is a batch of its own.
+    """
+    start = 0
+    batch_bytes = 0
+    for end, size in enumerate(sizes):
+        if end > start and batch_bytes + size > limit:
+            yield start, end
+            start = end
+            batch_bytes = 0
+        batch_bytes += size
+    if start < len(sizes):
+        yield start, len(sizes)
+
+
+def _read_text_file(file_path, display_path):
+    """
+    Reads a text file as UTF-8, falling back to latin-1.
+    Returns None if the file cannot be read.
+    """
+    return _read_file_contents(file_path, display_path)[0]
 
 
 class RepositoryProcessor:
+    # Fixed attribute layout; these are read for every file during the walk
+    __slots__ = (
+        'directory', 'output_file', 'gitignore_file', 'directories_to_skip',
+        'file_types_to_capture', 'special_exclude_dir_root', 'skip_filenames_set',
+        'max_file_bytes', 'max_cached_bytes', 'approx_small_files', '_capture_all', '_suffix_tuple',
+        '_exact_names', 'file_token_cache', 'file_aliases', 'file_contents', 'special_exclude_dir_abs',
+        'tokenizer_encoding', 'is_ignored', 'skip_dirs_abs', 'skip_basenames',
+    )
+
     def __init__(self, directory='./', output_file='combined_docs.txt', gitignore_file='./.gitignore',
                  directories_to_skip=None, file_types_to_capture=None,
-                 special_exclude_dir_root=None, filenames_to_skip=None):
+                 special_exclude_dir_root=None, filenames_to_skip=None, max_file_bytes=None,
+                 max_cached_bytes=256 * 1024 * 1024, approx_small_files=False):
         """
         Initializes the RepositoryProcessor with the given configuration.
 
@@ -27,41 +207,61 @@ class RepositoryProcessor:
                                                       Example: 'client/src/components'. Defaults to None.
             filenames_to_skip (list, optional): A list of exact filenames (e.g., ['config.py', 'NOTES.md'])
                                                 to skip regardless of their directory. Defaults to None.
+            max_file_bytes (int, optional): Files larger than this many bytes are skipped without
+                                            being read (e.g. 2 * 1024 * 1024). Defaults to None (no limit).
+            max_cached_bytes (int, optional): Approximate budget for file contents kept in memory between
+                                              the token counting pass and the output pass. If the total
+                                              size of the walked files exceeds it, no contents are kept:
+                                              files are counted in batches of READ_BATCH_BYTES and read
+                                              again when writing. Set to 0 for low-memory operation (two
+                                              full reads). Defaults to 256 MiB.
+            approx_small_files (bool, optional): Estimate the token count of files smaller than
+                                                 SMALL_FILE_BYTES as size // 4 instead of tokenizing
+                                                 them. On large repositories such files do not reach the
+                                                 top 5 and barely move the totals. Defaults to False
+                                                 (exact counts).
         """
         self.directory = os.path.abspath(directory)
         self.output_file = output_file
         self.gitignore_file = gitignore_file
         self.directories_to_skip = directories_to_skip or ['venv', '.git', 'notes', 'archive']
         self.file_types_to_capture = file_types_to_capture or []
+        # Capture rules precompiled for should_capture_file_type
+        self._capture_all = not self.file_types_to_capture
+        self._suffix_tuple = tuple(ft['match'] for ft in self.file_types_to_capture if ft['match_type'] == 'endswith')
+        self._exact_names = frozenset(ft['match'] for ft in self.file_types_to_capture if ft['match_type'] == 'equals')
         self.special_exclude_dir_root = special_exclude_dir_root
         self.skip_filenames_set = set(filenames_to_skip or [])
+        self.max_file_bytes = max_file_bytes
+        self.max_cached_bytes = max_cached_bytes
+        self.approx_small_files = approx_small_files
 
         # --- New: Cache for token counts ---
-        self.file_token_cache = {}
+        self.file_token_cache = {} # Maps file path -> (token_count, extension, relative path with '/' separators)
+        # Maps other walk paths of a cached file (symlinks to it) -> its cache key
+        self.file_aliases = {}
+        # Output contents read during token counting, so files are not read twice
+        self.file_contents = {}
         # ---
 
-        # Calculate the absolute path for the special exclusion directory if provided
+        # Calculate the absolute path for the special exclusion directory if provided.
+        # This is kept in the same (unresolved) form as the walk paths so the check
+        # in should_exclude_special_case is a plain string comparison.
         self.special_exclude_dir_abs = None
         if self.special_exclude_dir_root:
             # Handle cases where special_exclude_dir_root might be '.' or empty
             if self.special_exclude_dir_root and self.special_exclude_dir_root != '.':
                  normalized_special_path = os.path.join(*self.special_exclude_dir_root.split('/'))
-                 self.special_exclude_dir_abs = os.path.realpath(os.path.join(self.directory, normalized_special_path))
-                 logging.info(f"Special exclusion rule active for files directly within: {self.special_exclude_dir_abs}")
+                 self.special_exclude_dir_abs = os.path.normpath(os.path.join(self.directory, normalized_special_path))
+                 logger.info("Special exclusion rule active for files directly within: %s", self.special_exclude_dir_abs)
             else:
                  # If special root is '.' or empty, it refers to the main directory being processed
                  self.special_exclude_dir_abs = self.directory
-                 logging.info(f"Special exclusion rule active for files directly within the root directory: {self.directory}")
+                 logger.info("Special exclusion rule active for files directly within the root directory: %s", self.directory)
 
 
         # Initialize tokenizer encoding once
-        self.tokenizer_encoding = tiktoken.get_encoding("cl100k_base")
-
-        # Configure logging
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s'
-        )
+        self.tokenizer_encoding = _get_encoding("cl100k_base")
 
         # Parse .gitignore for exclusions
         try:
@@ -75,27 +275,32 @@ class RepositoryProcessor:
                      abs_gitignore_path = None # Indicate not found
 
             if abs_gitignore_path and os.path.exists(abs_gitignore_path):
-                self.is_ignored = parse_gitignore(abs_gitignore_path)
-                logging.info(f"Loaded .gitignore rules from: {abs_gitignore_path}")
+                # The same paths are matched from the walk and again from the structure
+                # pass, so memoize the match per path
+                self.is_ignored = lru_cache(maxsize=None)(_load_gitignore(abs_gitignore_path))
+                logger.info("Loaded .gitignore rules from: %s", abs_gitignore_path)
             else:
-                logging.warning(f".gitignore file not found at specified/relative paths. No gitignore rules applied.")
+                logger.warning(".gitignore file not found at specified/relative paths. No gitignore rules applied.")
                 self.is_ignored = lambda x: False
         except Exception as e:
-            logging.error(f"Error parsing .gitignore file '{self.gitignore_file}': {e}", exc_info=True)
+            logger.error("Error parsing .gitignore file '%s': %s", self.gitignore_file, e, exc_info=True)
             self.is_ignored = lambda x: False
 
-        # Calculate absolute paths of directories to skip
+        # Calculate absolute paths of directories to skip. These are kept in the same
+        # unresolved form as the paths os.walk joins, so pruning is a set lookup.
         self.skip_dirs_abs = set()
         for d in self.directories_to_skip:
             # Normalize path separators for comparison
             d_normalized = os.path.join(*d.split('/'))
-            skip_path_abs = os.path.realpath(os.path.join(self.directory, d_normalized))
+            skip_path_abs = os.path.normpath(os.path.join(self.directory, d_normalized))
             self.skip_dirs_abs.add(skip_path_abs)
+        # Bare names (no '/') are skipped at any depth, as documented in the configuration
+        self.skip_basenames = {d for d in self.directories_to_skip if '/' not in d}
 
-        logging.info(f"Original directories_to_skip: {self.directories_to_skip}")
-        logging.info(f"Absolute paths calculated for skip_dirs: {self.skip_dirs_abs}")
+        logger.info("Original directories_to_skip: %s", self.directories_to_skip)
+        logger.info("Absolute paths calculated for skip_dirs: %s", self.skip_dirs_abs)
         if self.skip_filenames_set:
-            logging.info(f"Skipping files with exact names: {self.skip_filenames_set}")
+            logger.info("Skipping files with exact names: %s", self.skip_filenames_set)
 
 
     def get_relative_path(self, path):
@@ -106,7 +311,7 @@ class RepositoryProcessor:
             return os.path.relpath(path, self.directory)
         except ValueError:
              # Handle cases where path might not be under self.directory (e.g., symlinks outside)
-             logging.warning(f"Could not get relative path for {path} against {self.directory}")
+             logger.warning("Could not get relative path for %s against %s", path, self.directory)
              return path # Return absolute path as fallback
 
 
@@ -115,47 +320,32 @@ class RepositoryProcessor:
         Counts tokens in a text file using the specified encoding.
         Returns 0 if the file cannot be read or decoded.
         """
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                text = f.read()
-        except UnicodeDecodeError:
+        if self.approx_small_files:
             try:
-                # Fallback encoding
-                with open(file_path, "r", encoding="latin-1") as f:
-                    text = f.read()
-                logging.warning(f"Encoding error (UTF-8) in file {self.get_relative_path(file_path)}, read with latin-1.")
-            except Exception as e_fallback:
-                logging.error(f"Could not read file {self.get_relative_path(file_path)} with UTF-8 or latin-1: {e_fallback}")
-                return 0
-        except FileNotFoundError:
-             logging.error(f"File not found during token counting: {self.get_relative_path(file_path)}")
-             return 0
-        except Exception as e:
-            logging.error(f"Error reading file {self.get_relative_path(file_path)} for token counting: {e}")
+                size = os.stat(file_path).st_size
+            except OSError:
+                size = None
+            if size is not None and size < SMALL_FILE_BYTES:
+                return _estimate_tokens(size)
+        text = _read_text_file(file_path, self.get_relative_path(file_path))
+        if text is None:
             return 0
-
         try:
-            tokens = self.tokenizer_encoding.encode(text)
-            return len(tokens)
+            return len(self.tokenizer_encoding.encode_ordinary(text))
         except Exception as e:
-             logging.error(f"Error encoding tokens for file {self.get_relative_path(file_path)}: {e}")
+             logger.error("Error encoding tokens for file %s: %s", self.get_relative_path(file_path), e)
              return 0
 
 
     def should_capture_file_type(self, file_name):
         """
         Check if a file matches the capture rules based on file type/name.
+        Returns the file's extension (see _file_extension) if it is captured, None otherwise,
+        so callers get the metrics key from the same check.
         """
-        if not self.file_types_to_capture:
-            return True
-        for file_type in self.file_types_to_capture:
-            match = file_type['match']
-            match_type = file_type['match_type']
-            if match_type == 'endswith' and file_name.endswith(match):
-                return True
-            elif match_type == 'equals' and file_name == match:
-                return True
-        return False
+        if self._capture_all or file_name.endswith(self._suffix_tuple) or file_name in self._exact_names:
+            return _file_extension(file_name)
+        return None
 
     def should_exclude_special_case(self, file_path):
         """
@@ -163,73 +353,186 @@ class RepositoryProcessor:
         """
         if not self.special_exclude_dir_abs:
             return False
-        try:
-            # Use resolved paths to handle symlinks consistently
-            parent_dir_abs = str(Path(file_path).resolve().parent)
-            special_exclude_resolved = str(Path(self.special_exclude_dir_abs).resolve())
-            if parent_dir_abs == special_exclude_resolved:
-                return True
-        except Exception as e:
-             logging.warning(f"Error resolving path for special case check {file_path}: {e}")
-        return False
+        # file_path is already an absolute walk path, so no filesystem lookup is needed
+        return os.path.dirname(file_path) == self.special_exclude_dir_abs
 
 
     def should_process_file(self, file_path, file_name):
         """
         Determines if a file should be processed based on all rules.
+        Returns the file's extension (truthy) if it should be processed, False otherwise.
         """
-        file_path_abs = os.path.realpath(file_path) # Use real path for checks
+        checked = self._check_file(file_path, file_name)
+        return checked[0] if checked else False
 
+    def _check_file(self, file_path, file_name):
+        """
+        Applies the should_process_file rules.
+        Returns (extension, os.stat_result, is_symlink) if the file should be processed, None
+        otherwise, so the walk gets the file size and link status from the same stat.
+        """
+        # file_path is the absolute path joined by the walker; it is used as-is
         # 1. Check .gitignore
-        if self.is_ignored(file_path_abs):
-            return False
+        if self.is_ignored(file_path):
+            return None
 
         # 2. Check specific filename skip list
         if file_name in self.skip_filenames_set:
-            return False
+            return None
 
         # 3. Check special exclusion rule
-        if self.should_exclude_special_case(file_path_abs):
-            return False
+        if self.should_exclude_special_case(file_path):
+            return None
 
         # 4. Check if file type should be captured
-        if not self.should_capture_file_type(file_name):
-            return False
+        file_extension = self.should_capture_file_type(file_name)
+        if not file_extension:
+            return None
 
-        # 5. Basic file system check (ensure it's actually a file)
-        if not os.path.isfile(file_path_abs):
+        # 5. Basic file system check (ensure it's actually a file) and size limit, from one stat.
+        #    lstat tells symlinks apart; only those need a second stat of their target.
+        try:
+            st = os.lstat(file_path)
+            is_symlink = stat.S_ISLNK(st.st_mode)
+            if is_symlink:
+                st = os.stat(file_path)
+        except OSError:
              # This might happen with broken symlinks etc.
-             # logging.warning(f"Path is not a file: {self.get_relative_path(file_path_abs)}")
-             return False
+             return None
+        if not stat.S_ISREG(st.st_mode):
+             # logger.warning("Path is not a file: %s", self.get_relative_path(file_path))
+             return None
+        if self.max_file_bytes is not None and st.st_size > self.max_file_bytes:
+             if logger.isEnabledFor(logging.INFO):
+                 logger.info("Skipping file larger than %s bytes: %s", self.max_file_bytes, self.get_relative_path(file_path))
+             return None
 
-        return True
+        return file_extension, st, is_symlink
 
     # --- New Method: Pre-calculate token counts ---
     def _calculate_and_cache_token_counts(self):
         """
         Walks the directory, identifies processable files, counts their tokens,
-        and stores the counts in self.file_token_cache.
+        and stores (token_count, extension, rel_unix_path) per file in self.file_token_cache.
+        Files are read on a thread pool in batches of about READ_BATCH_BYTES, and each
+        batch is tokenized with one encode_ordinary_batch call, which tiktoken
+        parallelizes across cores. If the walked files fit in max_cached_bytes, their
+        contents are kept in self.file_contents for write_combined_docs; otherwise none
+        are kept and only one batch is held in memory at a time.
         """
-        logging.info("Calculating token counts for processable files...")
+        logger.info("Calculating token counts for processable files...")
         self.file_token_cache = {} # Reset cache
-        processed_files_count = 0
-
-        for root, dirs, files in os.walk(self.directory, topdown=True):
-            root_realpath = os.path.realpath(root)
-            # Prune directories based on skip rules BEFORE iterating files within them
-            dirs[:] = [d for d in dirs if self.should_include_dir(os.path.join(root_realpath, d))]
+        self.file_aliases = {}
+        self.file_contents = {}
+        paths_to_count = []
+        extensions = []
+        rel_unix_paths = []
+        sizes = []
+        seen_files = {} # real path -> index in paths_to_count
+        alias_indexes = {} # other walk path of a counted file -> its index
+
+        # Bind per-file lookups to locals for the walk loop
+        directory = self.directory
+        # os.walk does not follow symlinked directories, so a walked path that is not itself
+        # a symlink has the real path of the resolved root plus its path below the root
+        root_realpath = os.path.realpath(directory)
+        join = os.path.join
+        should_include_dir = self.should_include_dir
+        check_file = self._check_file
+
+        for root, dirs, files in os.walk(directory, topdown=True):
+            # Prune directories based on skip rules BEFORE iterating files within them.
+            # Pruned subtrees are never descended into, so their children need no checks.
+            dirs[:] = [d for d in dirs if should_include_dir(join(root, d))]
+
+            # Relative directory prefix, computed once per directory rather than per file
+            root_rel = os.path.relpath(root, directory)
+            root_rel_prefix = '' if root_rel == '.' else _to_unix_path(root_rel) + '/'
 
             for file_name in files:
-                file_path = os.path.join(root_realpath, file_name)
-                # Use the consistent should_process_file check
-                if self.should_process_file(file_path, file_name):
-                    # Use realpath as the key for consistency
-                    file_path_abs = os.path.realpath(file_path)
-                    token_count = self.count_tokens(file_path_abs)
-                    self.file_token_cache[file_path_abs] = token_count
-                    processed_files_count += 1
-
-        logging.info(f"Token counts calculated and cached for {processed_files_count} files.")
+                # The joined walk path is the cache key; generate_repo_structure builds
+                # the same strings from os.scandir, so no realpath is needed
+                file_path = join(root, file_name)
+                # The same checks as should_process_file, also returning the extension and stat
+                checked = check_file(file_path, file_name)
+                if checked:
+                    file_extension, st, is_symlink = checked
+                    # A symlinked file and its target are one file: it is counted once, under
+                    # the target's path when both are walked, as the realpath keys used to do
+                    if is_symlink:
+                        real_path = os.path.realpath(file_path)
+                    else:
+                        real_path = root_realpath + file_path[len(directory):]
+                    index = seen_files.get(real_path)
+                    if index is not None:
+                        kept_path = paths_to_count[index]
+                        if os.path.islink(kept_path) and not os.path.islink(file_path):
+                            alias_indexes[kept_path] = index
+                            paths_to_count[index] = file_path
+                            extensions[index] = file_extension
+                            rel_unix_paths[index] = root_rel_prefix + file_name
+                        else:
+                            alias_indexes[file_path] = index
+                        continue
+                    seen_files[real_path] = len(paths_to_count)
+                    paths_to_count.append(file_path)
+                    extensions.append(file_extension)
+                    rel_unix_paths.append(root_rel_prefix + file_name)
+                    sizes.append(st.st_size)
+
+        # The stat sizes estimate the memory the contents would take
+        cache_contents = sum(sizes) <= self.max_cached_bytes
+        if not cache_contents:
+            logger.info("Files exceed max_cached_bytes (%s bytes); they will be read again when writing.",
+                        self.max_cached_bytes)
+
+        token_counts = []
+        cached_bytes = 0
+        with ThreadPoolExecutor() as executor:
+            for start, end in _size_batches(sizes, READ_BATCH_BYTES):
+                batch_paths = paths_to_count[start:end]
+                results = list(executor.map(_read_file_contents, batch_paths, rel_unix_paths[start:end]))
+                token_counts.extend(self._count_batch_tokens(batch_paths, results))
+                if not cache_contents:
+                    continue
+                for file_path_abs, (_, content) in zip(batch_paths, results):
+                    # A file over the budget is re-read when writing; smaller ones after it may still fit
+                    if content is None or cached_bytes + len(content) > self.max_cached_bytes:
+                        continue
+                    cached_bytes += len(content)
+                    self.file_contents[file_path_abs] = content
+
+        self.file_token_cache = dict(zip(paths_to_count, zip(token_counts, extensions, rel_unix_paths)))
+        self.file_aliases = {alias: paths_to_count[index] for alias, index in alias_indexes.items()}
+        logger.info("Token counts calculated and cached for %s files.", len(self.file_token_cache))
+
+    def _count_batch_tokens(self, file_paths, results):
+        """
+        Returns the token counts of one batch of files read by _read_file_contents.
+        Unreadable files count as 0 tokens.
+        """
+        readable = [i for i, (text, _) in enumerate(results) if text is not None]
+        token_counts = [0] * len(file_paths)
+        if self.approx_small_files:
+            # Estimate small files from their output size and only tokenize the rest
+            to_encode = []
+            for i in readable:
+                size = len(results[i][1])
+                if size < SMALL_FILE_BYTES:
+                    token_counts[i] = _estimate_tokens(size)
+                else:
+                    to_encode.append(i)
+            readable = to_encode
+        try:
+            token_lists = self.tokenizer_encoding.encode_ordinary_batch(
+                [results[i][0] for i in readable], num_threads=os.cpu_count() or 1
+            )
+            for i, tokens in zip(readable, token_lists):
+                token_counts[i] = len(tokens)
+        except Exception as e:
+            logger.error("Error batch encoding tokens, counting files one by one: %s", e)
+            token_counts = [self.count_tokens(file_path_abs) for file_path_abs in file_paths]
+        return token_counts
     # --- End New Method ---
 
 
@@ -237,29 +540,23 @@ class RepositoryProcessor:
         """
         Generates repository metrics using the pre-calculated token counts.
         """
-        file_metrics = defaultdict(lambda: {"count": 0, "tokens": 0})
-        total_files = 0
-        total_tokens = 0
-        token_counts_rel = {} # Store relative paths here for top files output
-
-        # Iterate through the cached token counts
-        for file_path_abs, token_count in self.file_token_cache.items():
-            # No need to call should_process_file again, cache only contains processable files
-            try:
-                file_name = os.path.basename(file_path_abs)
-                relative_path = self.get_relative_path(file_path_abs)
-
-                total_files += 1
-                total_tokens += token_count
-                file_extension = os.path.splitext(file_name)[-1] or file_name # Handle no extension
-                file_metrics[file_extension]["count"] += 1
-                file_metrics[file_extension]["tokens"] += token_count
-                token_counts_rel[relative_path] = token_count
-            except Exception as e:
-                 logging.error(f"Error processing cached file {file_path_abs} for metrics: {e}")
-
-
-        top_files = sorted(token_counts_rel.items(), key=lambda item: item[1], reverse=True)[:5]
+        # Each cache entry is (token_count, extension, rel_unix_path), so no path parsing is needed here
+        file_counts = defaultdict(int)
+        file_tokens = defaultdict(int)
+        for token_count, file_extension, _ in self.file_token_cache.values():
+            file_counts[file_extension] += 1
+            file_tokens[file_extension] += token_count
+
+        file_metrics = {
+            file_extension: {"count": count, "tokens": file_tokens[file_extension]}
+            for file_extension, count in file_counts.items()
+        }
+        total_files = len(self.file_token_cache)
+        total_tokens = sum(file_tokens.values())
+
+        # nlargest keeps sorted()'s tie order
+        largest = heapq.nlargest(5, self.file_token_cache.values(), key=lambda entry: entry[0])
+        top_files = [(rel_unix_path, token_count) for token_count, _, rel_unix_path in largest]
         return total_files, total_tokens, file_metrics, top_files
 
 
@@ -269,93 +566,105 @@ class RepositoryProcessor:
         including token counts for files, respecting all skip rules.
         """
         structure_lines = []
-        root_path = Path(self.directory)
+
+        # Bind per-entry lookups to locals for the recursion
+        is_ignored = self.is_ignored
+        should_include_dir = self.should_include_dir
+        skip_filenames_set = self.skip_filenames_set
+        should_exclude_special_case = self.should_exclude_special_case
+        should_capture_file_type = self.should_capture_file_type
+        file_token_cache = self.file_token_cache
+        file_aliases = self.file_aliases
 
         # --- Inner recursive function ---
-        def tree(dir_path: Path, prefix: str = ''):
+        def tree(dir_path: str, prefix: str = ''):
             try:
                 contents = []
-                # Iterate and filter items in the current directory
-                for p in dir_path.iterdir():
-                    try:
-                        p_abs = str(p.resolve()) # Use resolved absolute path for checks
-                        p_name = p.name
-
-                        # --- Filtering Logic ---
-                        # 1. Gitignore check
-                        if self.is_ignored(p_abs): continue
-
-                        # 2. Directory specific checks
-                        if p.is_dir():
-                            if not self.should_include_dir(p_abs): continue
-                        # 3. File specific checks
-                        elif p.is_file():
-                            if p_name in self.skip_filenames_set: continue
-                            if self.should_exclude_special_case(p_abs): continue
-                            # Check if file type is captured (important for structure consistency)
-                            if not self.should_capture_file_type(p_name): continue
-                            # Final check: ensure it's in our cache (meaning it passed all checks)
-                            if p_abs not in self.file_token_cache: continue
-                        # 4. Handle other types like symlinks (optional: decide if they should be listed)
-                        #    Currently, only files and included directories are added.
-                        else:
-                             continue # Skip symlinks, sockets, etc.
-
-                        # If all checks pass, add to contents for this level
-                        contents.append(p)
-
-                    except OSError as oe:
-                         # Handle errors like broken symlinks during iteration/resolve
-                         logging.warning(f"OS error processing path {p} in {dir_path}: {oe}")
-                         continue
-                    except Exception as ie:
-                         logging.error(f"Unexpected error processing path {p} in {dir_path}: {ie}", exc_info=True)
-                         continue
+                # Iterate and filter items in the current directory. DirEntry caches the
+                # file type from the directory listing, so no extra stat calls are made.
+                with os.scandir(dir_path) as it:
+                    for entry in it:
+                        try:
+                            p_abs = entry.path
+                            p_name = entry.name
+
+                            # --- Filtering Logic ---
+                            # 1. Directory specific checks (symlinked directories are not followed).
+                            #    should_include_dir also applies the gitignore rules.
+                            if entry.is_dir(follow_symlinks=False):
+                                if not should_include_dir(p_abs): continue
+                                is_dir = True
+                            # 2. File specific checks (symlinked files are listed, like in os.walk)
+                            elif entry.is_file():
+                                if is_ignored(p_abs): continue
+                                if p_name in skip_filenames_set: continue
+                                if should_exclude_special_case(p_abs): continue
+                                # Check if file type is captured (important for structure consistency)
+                                if not should_capture_file_type(p_name): continue
+                                # Final check: ensure it's in our cache (meaning it passed all checks).
+                                # Other paths of a counted file are listed with its token count.
+                                if file_aliases.get(p_abs, p_abs) not in file_token_cache: continue
+                                is_dir = False
+                            # 3. Handle other types like symlinks (optional: decide if they should be listed)
+                            #    Currently, only files and included directories are added.
+                            else:
+                                 continue # Skip symlinked directories, sockets, etc.
+
+                            # If all checks pass, add to contents for this level
+                            contents.append((entry, is_dir))
+
+                        except OSError as oe:
+                             # Handle errors like broken symlinks during iteration
+                             logger.warning("OS error processing path %s in %s: %s", entry.path, dir_path, oe)
+                             continue
+                        except Exception as ie:
+                             logger.error("Unexpected error processing path %s in %s: %s", entry.path, dir_path, ie, exc_info=True)
+                             continue
 
 
                 # Sort directories first, then files, alphabetically within each group
-                contents.sort(key=lambda p: (not p.is_dir(), p.name.lower()))
+                contents.sort(key=lambda item: (not item[1], item[0].name.lower()))
 
             except PermissionError as e:
-                logging.warning(f"Permission error accessing {dir_path}: {e}")
+                logger.warning("Permission error accessing %s: %s", dir_path, e)
                 return # Stop recursion for this branch
             except FileNotFoundError as e:
-                 logging.warning(f"Directory not found during tree generation {dir_path}: {e}")
+                 logger.warning("Directory not found during tree generation %s: %s", dir_path, e)
                  return # Stop recursion for this branch
             except Exception as e:
-                 logging.error(f"Error listing directory contents for {dir_path}: {e}", exc_info=True)
+                 logger.error("Error listing directory contents for %s: %s", dir_path, e, exc_info=True)
                  return
 
             # --- Generate output lines for this level ---
             pointers = ['├── '] * (len(contents) - 1) + ['└── '] if contents else []
-            for pointer, path in zip(pointers, contents):
-                entry_name = path.name
+            for pointer, (entry, is_dir) in zip(pointers, contents):
+                entry_name = entry.name
                 # --- Append token count for files ---
-                if path.is_file():
-                    p_abs = str(path.resolve())
-                    token_count = self.file_token_cache.get(p_abs, None) # Get from cache
-                    if token_count is not None:
+                if not is_dir:
+                    cached = file_token_cache.get(file_aliases.get(entry.path, entry.path), None) # Get from cache
+                    if cached is not None:
+                        token_count = cached[0]
                         entry_name += f" ({token_count} tokens)"
                     else:
                         # This case should ideally not happen if caching is done correctly
                         entry_name += " (tokens N/A)"
-                        logging.warning(f"Token count missing in cache for file in structure: {p_abs}")
+                        logger.warning("Token count missing in cache for file in structure: %s", entry.path)
                 # --- Yield the line ---
                 yield prefix + pointer + entry_name
 
                 # --- Recurse into subdirectories ---
-                if path.is_dir():
+                if is_dir:
                     extension = '│   ' if pointer == '├── ' else '    '
-                    yield from tree(path, prefix=prefix + extension)
+                    yield from tree(entry.path, prefix=prefix + extension)
         # --- End of inner function ---
 
         try:
             # Start the tree generation
-            structure_lines.append(f"{root_path.name}/") # Add trailing slash to indicate root dir
-            structure_lines.extend(list(tree(root_path)))
+            structure_lines.append(f"{os.path.basename(self.directory)}/") # Add trailing slash to indicate root dir
+            structure_lines.extend(list(tree(self.directory)))
             structure = '\n'.join(structure_lines)
         except Exception as e:
-            logging.error(f"Error generating repository structure: {e}", exc_info=True)
+            logger.error("Error generating repository structure: %s", e, exc_info=True)
             structure = 'Error generating structure.'
 
         return structure
@@ -382,39 +691,29 @@ class RepositoryProcessor:
             bool: True if the directory should be included, False otherwise.
         """
         try:
-            dir_realpath = os.path.realpath(dir_path) # Resolve symlinks for consistent checks
-
-            # 1. Check if the exact absolute path is in the calculated skip set
-            if dir_realpath in self.skip_dirs_abs:
-                # logging.debug(f"Skipping directory via absolute path match: {self.get_relative_path(dir_realpath)}")
+            # 1. Check the bare-name and exact absolute path skip sets.
+            #    Callers prune during traversal, so a subdirectory of a skipped path
+            #    is never reached and no ancestor check is needed.
+            if os.path.basename(dir_path) in self.skip_basenames or dir_path in self.skip_dirs_abs:
+                # logger.debug("Skipping directory via absolute path match: %s", self.get_relative_path(dir_path))
                 return False
 
             # 2. Check if the directory is ignored by .gitignore
-            #    Need to check with and without trailing slash for gitignore compatibility
-            if self.is_ignored(dir_realpath) or self.is_ignored(dir_realpath + os.sep):
-                # logging.debug(f"Skipping directory via .gitignore: {self.get_relative_path(dir_realpath)}")
+            #    Directories are always matched in their trailing-slash form, which
+            #    also lets directory-only patterns apply
+            if self.is_ignored(dir_path + os.sep):
+                # logger.debug("Skipping directory via .gitignore: %s", self.get_relative_path(dir_path))
                 return False
 
-            # 3. Check if any parent directory's absolute path is in skip_dirs_abs
-            #    This prevents walking into subdirs of explicitly skipped paths.
-            parent = Path(dir_realpath).parent
-            root_dir_resolved = Path(self.directory).resolve()
-            # Stop when we go above the root processing directory or hit the filesystem root
-            while parent != parent.parent and parent.resolve() != root_dir_resolved.parent:
-                if str(parent.resolve()) in self.skip_dirs_abs:
-                    # logging.debug(f"Skipping directory because parent '{self.get_relative_path(str(parent.resolve()))}' is skipped: {self.get_relative_path(dir_realpath)}")
-                    return False
-                parent = parent.parent
-
             # If none of the above apply, include the directory
             return True
 
         except OSError as e:
              # Handle cases like broken symlinks when checking paths
-             logging.warning(f"OS error checking directory inclusion for {dir_path}: {e}")
+             logger.warning("OS error checking directory inclusion for %s: %s", dir_path, e)
              return False
         except Exception as e:
-             logging.error(f"Unexpected error checking directory inclusion for {dir_path}: {e}", exc_info=True)
+             logger.error("Unexpected error checking directory inclusion for %s: %s", dir_path, e, exc_info=True)
              return False
 
 
@@ -428,129 +727,117 @@ class RepositoryProcessor:
                 tokens = self.tokenizer_encoding.encode(text)
                 return len(tokens)
         except FileNotFoundError:
-            logging.error(f"Output file {self.output_file} not found for token counting.")
+            logger.error("Output file %s not found for token counting.", self.output_file)
             return 0
         except Exception as e:
-            logging.error(f"Error reading output file {self.output_file}: {e}")
+            logger.error("Error reading output file %s: %s", self.output_file, e)
             return 0
 
-    def write_combined_docs(self):
+    def _count_bytes_tokens(self, data):
+        """
+        Counts tokens in a UTF-8 encoded block of generated output.
+        """
+        try:
+            return len(self.tokenizer_encoding.encode_ordinary(data.decode('utf-8', errors='replace')))
+        except Exception as e:
+            logger.error("Error encoding tokens for output block: %s", e)
+            return 0
+
+    def write_combined_docs(self, verify_output_tokens=False):
         """
         Generates the combined document of the repository files.
+
+        The reported output token total is the sum of the cached per-file counts
+        and the counts of the generated header blocks, so the output file is not
+        re-tokenized. BPE merges can differ slightly at block boundaries, so the
+        total may differ from a full re-encode by a few tokens; pass
+        verify_output_tokens=True to re-tokenize the finished file for an exact count.
         """
-        logging.info(f"Starting processing for directory: {self.directory}")
-        logging.info(f"Output file: {self.output_file}")
+        logger.info("Starting processing for directory: %s", self.directory)
+        logger.info("Output file: %s", self.output_file)
 
         try:
             # --- Step 1: Pre-calculate token counts for all processable files ---
             self._calculate_and_cache_token_counts()
 
             # --- Step 2: Generate metrics using the cached counts ---
-            logging.info("Generating repository metrics from cached data...")
+            logger.info("Generating repository metrics from cached data...")
             total_files, total_tokens, file_metrics, top_files = self.generate_repo_metrics()
-            logging.info(f"Metrics generated: {total_files} files, {total_tokens} tokens.")
+            logger.info("Metrics generated: %s files, %s tokens.", total_files, total_tokens)
 
             # --- Step 3: Generate structure using cached counts ---
-            logging.info("Generating repository structure with token counts...")
+            logger.info("Generating repository structure with token counts...")
             repo_structure = self.generate_repo_structure()
-            logging.info("Repository structure generated.")
+            logger.info("Repository structure generated.")
 
-            # --- Step 4: Get the final list of files to include (from cache keys) ---
-            logging.info("Collecting files to include from cache...")
-            all_files_to_include = self.get_all_files() # Uses cache keys
-            logging.info(f"Found {len(all_files_to_include)} files to include in the output.")
+            # --- Step 4: Get the final list of files to include (from the cache) ---
+            logger.info("Collecting files to include from cache...")
+            # Sort files by relative path for consistent output order
+            files_to_include = sorted(self.file_token_cache.items(), key=lambda item: item[1][2])
+            logger.info("Found %s files to include in the output.", len(files_to_include))
 
             # --- Step 5: Write the output file ---
-            logging.info(f"Writing combined document to {self.output_file}...")
-            with open(self.output_file, 'w', encoding='utf-8') as outfile:
+            logger.info("Writing combined document to %s...", self.output_file)
+            with open(self.output_file, 'wb', buffering=WRITE_BUFFER) as outfile:
                 # Write header sections (Introduction, Summary, Metrics, Structure)
-                outfile.write("****** DOCUMENT INTRODUCTION ******\n\n")
-                outfile.write(
-                    "This file is a merged representation of the codebase, combining selected repository files into a single document.\n"
-                    "Files ignored by .gitignore, specific skip rules (directories, filenames, special cases), or file type filters are excluded.\n"
-                )
-                outfile.write("\n================================================================\n")
-                outfile.write("File Summary\n")
-                outfile.write("================================================================\n\n")
-                outfile.write("Purpose:\n--------\n")
-                outfile.write(
-                    "This file contains a packed representation of the repository's relevant contents.\n"
-                    "It is designed to be easily consumable by AI systems for analysis, code review,\n"
-                    "or other automated processes.\n\n"
-                )
-                outfile.write("File Format:\n------------\n")
-                outfile.write(
-                    "The content is organized as follows:\n"
-                    "1. This summary section\n"
-                    "2. Repository metrics (based on included files)\n"
-                    "3. Repository structure (visual tree with token counts, respecting ignores/skips)\n" # Updated description
-                    "4. Multiple file entries, each consisting of:\n"
-                    "  a. A separator line (================)\n"
-                    "  b. The file path relative to the root (File: path/to/file)\n"
-                    "  c. Another separator line\n"
-                    "  d. The full contents of the file\n"
-                    "  e. A blank line\n\n"
-                )
-
-                outfile.write("\n================================================================\n")
-                outfile.write("Repository Metrics (Included Files)\n")
-                outfile.write("================================================================\n\n")
-                outfile.write(f"Total Files Included: {total_files}\n")
-                outfile.write(f"Total Tokens (Included Files): {total_tokens}\n")
+                metrics_lines = [
+                    f"Total Files Included: {total_files}\n",
+                    f"Total Tokens (Included Files): {total_tokens}\n",
+                ]
                 if file_metrics:
-                    outfile.write("Included Files by Type:\n")
+                    metrics_lines.append("Included Files by Type:\n")
                     for file_type, metrics in sorted(file_metrics.items()):
-                        outfile.write(f"    - {file_type}: {metrics['count']} ({metrics['tokens']} tokens)\n")
+                        metrics_lines.append(f"    - {file_type}: {metrics['count']} ({metrics['tokens']} tokens)\n")
                 else:
-                     outfile.write("No files included based on current filters.\n")
+                     metrics_lines.append("No files included based on current filters.\n")
                 if top_files:
-                    outfile.write("\nTop 5 Included Files by Tokens:\n")
+                    metrics_lines.append("\nTop 5 Included Files by Tokens:\n")
                     for file_path, token_count in top_files:
-                        # Ensure consistent path separators in output
-                        outfile.write(f"    - {file_path.replace(os.sep, '/')}: {token_count} tokens\n")
-                outfile.write("\n")
-
-                outfile.write("\n================================================================\n")
-                outfile.write("Repository Structure (Filtered, with Token Counts)\n") # Updated title
-                outfile.write("================================================================\n\n")
-                outfile.write(repo_structure)
-                outfile.write("\n")
-
-                # Write the repository files content
-                outfile.write("\n================================================================\n")
-                outfile.write("Repository Files Content\n")
-                outfile.write("================================================================\n\n")
-
-                # Sort files by path for consistent output order
-                all_files_to_include.sort()
-
-                for file_path_abs in all_files_to_include:
+                        # Paths already use '/' separators (see _calculate_and_cache_token_counts)
+                        metrics_lines.append(f"    - {file_path}: {token_count} tokens\n")
+                metrics_lines.append("\n")
+                header_block = HEADER_INTRO + HEADER_METRICS + "".join(metrics_lines).encode('utf-8')
+                structure_block = HEADER_STRUCTURE + repo_structure.encode('utf-8') + b"\n" + HEADER_FILES
+                outfile.write(header_block)
+                outfile.write(structure_block)
+                output_tokens = self._count_bytes_tokens(header_block) + self._count_bytes_tokens(structure_block)
+                file_trailer_tokens = self._count_bytes_tokens(b"\n\n")
+
+                for file_path_abs, (token_count, _, relative_file_path_unix) in files_to_include:
                     try:
-                        with open(file_path_abs, 'r', encoding='utf-8', errors='replace') as infile:
-                            content = infile.read()
-                            relative_file_path = self.get_relative_path(file_path_abs)
-                            relative_file_path_unix = relative_file_path.replace(os.sep, '/')
-                            outfile.write(f"================\nFile: {relative_file_path_unix}\n================\n")
-                            outfile.write(content)
-                            outfile.write("\n\n") # Ensure separation between files
+                        # Use the contents read during token counting when available
+                        content = self.file_contents.pop(file_path_abs, None)
+                        if content is None:
+                            with open(file_path_abs, 'rb') as infile:
+                                content = _output_bytes(infile.read())
+                        file_header = FILE_SEPARATOR + b"File: " + relative_file_path_unix.encode('utf-8') + b"\n" + FILE_SEPARATOR
+                        # One call per file entry; the buffered writer batches them into large writes
+                        outfile.writelines((file_header, content, b"\n\n")) # Ensure separation between files
+                        output_tokens += (self._count_bytes_tokens(file_header)
+                                          + token_count + file_trailer_tokens)
                     except FileNotFoundError:
                          # Should not happen if cache is correct, but handle defensively
-                         logging.warning(f"File from cache not found during writing: {file_path_abs}")
+                         logger.warning("File from cache not found during writing: %s", file_path_abs)
                     except Exception as e:
-                        logging.error(f"Error reading/writing file content for {self.get_relative_path(file_path_abs)}: {e}")
+                        logger.error("Error reading/writing file content for %s: %s", relative_file_path_unix, e)
 
-            logging.info(f"Combined document generated successfully at {self.output_file}")
+            logger.info("Combined document generated successfully at %s", self.output_file)
 
-            total_output_tokens = self.count_output_tokens()
+            total_output_tokens = self.count_output_tokens() if verify_output_tokens else output_tokens
             if total_output_tokens > 0:
                 print(f"Total tokens in the final output file '{self.output_file}': {total_output_tokens}")
-                logging.info(f"Total tokens in the final output file '{self.output_file}': {total_output_tokens}")
+                logger.info("Total tokens in the final output file '%s': %s", self.output_file, total_output_tokens)
 
         except Exception as e:
-            logging.critical(f"An unexpected error occurred during write_combined_docs: {e}", exc_info=True)
+            logger.critical("An unexpected error occurred during write_combined_docs: %s", e, exc_info=True)
 
 
 if __name__ == "__main__":
+    # Configure logging (only when run as a script, so importing has no side effects)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
     try:
         # --- Configuration ---
         target_directory = './client/src'
@@ -615,5 +902,5 @@ if __name__ == "__main__":
         sys.exit(0) # Indicate success
 
     except Exception as e:
-        logging.critical(f"Script terminated due to an unexpected error: {e}", exc_info=True)
+        logger.critical("Script terminated due to an unexpected error: %s", e, exc_info=True)
         sys.exit(1) # Indicate failure
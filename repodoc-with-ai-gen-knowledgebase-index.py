@@ -1,13 +1,205 @@
 import os
 import sys
+import shutil
 import logging
 import json
 import asyncio
-from collections import defaultdict
-from gitignore_parser import parse_gitignore
+import codecs
+import hashlib
+import heapq
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import NamedTuple
+import pathspec
 import tiktoken
 from langchain.chat_models import ChatOpenAI
 
+# orjson parses notebooks in native code; it is optional and json is used without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Buffer size for reading repository files; larger than io.DEFAULT_BUFFER_SIZE to cut read syscalls
+READ_BUFFER = 128 * 1024
+# Buffer size for the combined output stream
+WRITE_BUFFER = 1 << 20
+
+# Extensions that are never text; such files are skipped without being opened
+BINARY_EXTS = frozenset({
+    '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.ico', '.webp', '.tiff',
+    '.pdf', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.tar',
+    '.exe', '.dll', '.so', '.dylib', '.o', '.a', '.lib', '.bin', '.class', '.jar',
+    '.pyc', '.pyo', '.whl', '.mp3', '.mp4', '.wav', '.avi', '.mov', '.woff', '.woff2',
+    '.ttf', '.otf', '.eot', '.db', '.sqlite', '.parquet', '.pkl', '.npy', '.npz',
+})
+# Leading bytes inspected for a NUL byte to detect binary files with other extensions
+BINARY_SNIFF_BYTES = 4096
+# Below this many captured files a process pool costs more to start than it saves
+PROCESS_POOL_MIN_FILES = 200
+# Maximum number of LLM requests in flight while building the knowledge base overview
+LLM_CONCURRENCY = 16
+# Characters of each file sent for review, and the bytes that can hold them in UTF-8
+REVIEW_MAX_CHARS = 3000
+REVIEW_MAX_BYTES = REVIEW_MAX_CHARS * 4
+
+# Bounded pool for review_file reads that miss the content cache, shared by all processors
+_READ_EXECUTOR = ThreadPoolExecutor(max_workers=32)
+
+# Tokenizer and content-hash token cache owned by each process-pool worker
+_WORKER_ENCODING = None
+_WORKER_TOKEN_CACHE = {}
+
+
+def _translate_newlines(data):
+    """
+    Applies text-mode universal newline handling (\\r\\n and \\r become \\n) to file bytes.
+    CR and LF never occur inside a multibyte UTF-8 sequence, so this matches reading the
+    file in text mode.
+    """
+    if b"\r" in data:
+        return data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    return data
+
+
+def _is_binary_file(file_path):
+    """
+    Returns True if a NUL byte appears in the first BINARY_SNIFF_BYTES of a file,
+    the same test the scan applies. Unreadable files are not reported as binary.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            return b"\x00" in f.read(BINARY_SNIFF_BYTES)
+    except OSError:
+        return False
+
+
+def _read_and_encode_file(file_path, encoding, token_cache):
+    """
+    Reads and tokenizes a single file with the given tiktoken encoding.
+    token_cache maps a BLAKE2b digest of file contents to its token count, so identical
+    files (license headers, generated or vendored copies) are only encoded once.
+    Returns (file_path, content_bytes, token_count, translated); content_bytes is None if
+    the file could not be read or decoded, and token_count is also None if the file was
+    skipped as binary because a NUL byte appears in its first BINARY_SNIFF_BYTES.
+    content_bytes has universal newlines applied (see _translate_newlines); translated
+    is True if that changed it, so the file's raw bytes cannot be copied as they are.
+    """
+    try:
+        with open(file_path, "rb", buffering=READ_BUFFER) as f:
+            head = f.read(BINARY_SNIFF_BYTES)
+            if b"\x00" in head:
+                logging.info(f"Skipping binary file {file_path}")
+                return file_path, None, None, False
+            content = head + f.read() if len(head) == BINARY_SNIFF_BYTES else head
+    except Exception as e:
+        logging.error(f"Error reading file {file_path}: {e}")
+        return file_path, None, 0, False
+    translated = b"\r" in content
+    if translated:
+        content = _translate_newlines(content)
+    try:
+        text = content.decode("utf-8")
+    except UnicodeDecodeError as e:
+        logging.error(f"Encoding error in file {file_path}: {e}")
+        return file_path, None, 0, False
+    digest = hashlib.blake2b(content, digest_size=16).digest()
+    token_count = token_cache.get(digest)
+    if token_count is not None:
+        return file_path, content, token_count, translated
+    try:
+        token_count = token_cache[digest] = len(encoding.encode_ordinary(text))
+        return file_path, content, token_count, translated
+    except Exception as e:
+        logging.error(f"Error encoding tokens for file {file_path}: {e}")
+        return file_path, content, 0, translated
+
+
+def _load_gitignore(gitignore_path):
+    """
+    Compiles a .gitignore file into a matcher for absolute paths.
+    Paths are matched relative to the directory containing the .gitignore; a
+    trailing separator marks a directory. Paths outside that directory are
+    never ignored.
+    """
+    with open(gitignore_path, 'r', encoding='utf-8') as f:
+        spec = pathspec.GitIgnoreSpec.from_lines(f)
+    base_prefix = os.path.join(os.path.dirname(os.path.abspath(gitignore_path)), '')
+
+    def is_ignored(path):
+        # Walked paths are absolute and normalized, so a prefix slice gives the relative path
+        if not path.startswith(base_prefix):
+            return False
+        return spec.match_file(path[len(base_prefix):])
+
+    return is_ignored
+
+
+def _load_json(content):
+    """
+    Parses JSON text with orjson when it is installed, otherwise with json.
+    Documents orjson rejects but json accepts (e.g. NaN values) fall back to json.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(content)
+
+
+def _decode_utf8_prefix(data):
+    """
+    Decodes a UTF-8 prefix of a file, dropping a character cut off at the end.
+    Invalid bytes still raise UnicodeDecodeError.
+    """
+    return codecs.getincrementaldecoder('utf-8')().decode(data)
+
+
+def _init_worker():
+    """
+    Process-pool initializer: gives each worker process its own tokenizer.
+    """
+    global _WORKER_ENCODING
+    _WORKER_ENCODING = tiktoken.get_encoding("cl100k_base")
+
+
+def _read_and_encode_in_worker(file_path):
+    """
+    Process-pool task wrapping _read_and_encode_file with the worker's tokenizer.
+    """
+    return _read_and_encode_file(file_path, _WORKER_ENCODING, _WORKER_TOKEN_CACHE)
+
+
+# Static parts of the combined document, pre-encoded once
+SEPARATOR = b"================================================================\n"
+FILE_SEPARATOR = b"================\n"
+HEADER_INTRO = (
+    b"****** DOCUMENT INTRODUCTION ******\n\n"
+    b"This file is a merged representation of the entire codebase, combining all repository files into a single document.\n"
+    b"\n" + SEPARATOR +
+    b"File Summary\n" +
+    SEPARATOR + b"\n"
+    b"Purpose:\n--------\n"
+    b"This file contains a packed representation of the entire repository's contents.\n"
+    b"It is designed to be easily consumable by AI systems for analysis, code review,\n"
+    b"or other automated processes.\n\n"
+    b"File Format:\n------------\n"
+    b"The content is organized as follows:\n"
+    b"1. This summary section\n"
+    b"2. Repository metrics\n"
+    b"3. Repository structure\n"
+    b"4. Multiple file entries, each consisting of:\n"
+    b"  a. A separator line (================)\n"
+    b"  b. The file path (File: path/to/file)\n"
+    b"  c. Another separator line\n"
+    b"  d. The full contents of the file\n"
+    b"  e. A blank line\n\n"
+)
+HEADER_METRICS = b"\n" + SEPARATOR + b"Repository Metrics\n" + SEPARATOR + b"\n"
+HEADER_STRUCTURE = b"\n" + SEPARATOR + b"Repository Structure\n" + SEPARATOR + b"\n"
+HEADER_FILES = b"\n" + SEPARATOR + b"Repository Files\n" + SEPARATOR + b"\n"
+
 # log level
 logging.basicConfig(
     filename='script.log',
@@ -15,21 +207,85 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+class ScanResult(NamedTuple):
+    """
+    Everything collected by a single pass over the repository.
+    all_files holds (file_path, relative_path, content, token_count) tuples for every readable
+    file, in walk order. content is the file's UTF-8 bytes with universal newlines applied,
+    or None if it was not kept in memory because the max_cached_bytes budget was exhausted.
+    newline_files holds the paths of such uncached files whose newlines had to be translated,
+    so they are read again rather than copied byte for byte.
+    review_files lists, in walk order, every captured file that was not skipped as oversized
+    or binary, including files that could not be read; these are the files reviewed for the
+    knowledge base overview.
+    """
+    all_files: list
+    total_files: int
+    total_tokens: int
+    file_metrics: dict
+    top_files: list
+    newline_files: frozenset
+    review_files: list
+
+
 class RepositoryProcessor:
     def __init__(self, directory='./', output_file='combined_docs.txt', gitignore_file='./.gitignore',
-                 directories_to_skip=None, file_types_to_capture=None):
+                 directories_to_skip=None, file_types_to_capture=None, max_cached_bytes=256 * 1024 * 1024,
+                 parallelism=None, llm_concurrency=LLM_CONCURRENCY, max_file_bytes=None):
         """
         Initializes the RepositoryProcessor with the given configuration.
+        max_cached_bytes bounds how much file content the scan keeps in memory for writing the
+        combined document; files beyond the budget are read again from disk when written.
+        parallelism selects how files are tokenized: None uses a thread pool, while 'auto'
+        (one process per CPU) or an int process count fans out to a process pool, each worker
+        owning its own tokenizer, once there are at least PROCESS_POOL_MIN_FILES files.
+        llm_concurrency caps how many file reviews wait on the LLM at the same time.
+        max_file_bytes, if set, skips files larger than that many bytes without reading them.
         """
         self.directory = os.path.abspath(directory)
+        # Resolved once; every other real path is derived from it (see _canonical)
+        self._root_realpath = os.path.realpath(self.directory)
+        # Separator-terminated root, so relative paths of walked files are a slice
+        self._dir_prefix = os.path.join(self.directory, '')
         self.output_file = output_file
         self.gitignore_file = gitignore_file
         self.directories_to_skip = directories_to_skip or ['venv', '.git', 'notes', 'archive']
         self.file_types_to_capture = file_types_to_capture or []
+        self.max_cached_bytes = max_cached_bytes
+        self.parallelism = parallelism
+        self.max_file_bytes = max_file_bytes
+        self.llm_concurrency = llm_concurrency
+        # Created per event loop by build_knowledge_base_overview (or lazily on first review)
+        self._llm_semaphore = None
+        # File bytes kept from the last write_combined_docs scan, reused by review_file
+        self._content_cache = {}
+        # Files accepted by the last scan, reviewed by build_knowledge_base_overview
+        self._review_files = None
+
+        # Compile capture rules into an exact-name set and a suffix tuple for str.endswith
+        self._exact_names = frozenset(
+            ft['match'] for ft in self.file_types_to_capture if ft['match_type'] == 'equals'
+        )
+        self._suffixes = tuple(
+            ft['match'] for ft in self.file_types_to_capture if ft['match_type'] == 'endswith'
+        )
 
         # Initialize tokenizer encoding once
         self.tokenizer_encoding = tiktoken.get_encoding("cl100k_base")
 
+        # Token counts keyed by content digest, shared by the scan's worker threads
+        self._token_cache = {}
+
+        # Token counts of the static document parts, so the output total can be summed
+        # while writing instead of re-tokenizing the finished file
+        self._static_header_tokens = sum(
+            self._count_bytes_tokens(header)
+            for header in (HEADER_INTRO, HEADER_METRICS, HEADER_STRUCTURE, HEADER_FILES)
+        )
+        self._file_trailer_tokens = self._count_bytes_tokens(b"\n\n")
+        # Per-file header without its path; the path itself is counted per file
+        self._file_header_tokens = self._count_bytes_tokens(FILE_SEPARATOR + b"File: \n" + FILE_SEPARATOR)
+
         # Configure logging
         logging.basicConfig(
             filename='script.log',
@@ -39,13 +295,41 @@ class RepositoryProcessor:
 
         # Parse .gitignore for exclusions
         try:
-            self.is_ignored = parse_gitignore(self.gitignore_file)
+            raw_is_ignored = _load_gitignore(self.gitignore_file)
         except Exception as e:
             logging.error(f"Error parsing .gitignore file: {e}")
-            self.is_ignored = lambda x: False  # No files are ignored if parsing fails
+            raw_is_ignored = lambda x: False  # No files are ignored if parsing fails
+
+        # Memoize .gitignore verdicts per path; the cache is cleared at the start of each scan.
+        # Directories are queried with a trailing separator so directory-only patterns apply.
+        self._ignore_cache = {}
+
+        def cached_is_ignored(path):
+            ignored = self._ignore_cache.get(path)
+            if ignored is None:
+                ignored = self._ignore_cache[path] = bool(raw_is_ignored(path))
+            return ignored
+
+        self.is_ignored = cached_is_ignored
+
+        # Directory listings keyed by path, shared by the scan and the structure tree of
+        # write_combined_docs so each directory is read from the kernel once; cleared
+        # at the start of each scan and once a tree is built
+        self._dir_cache = {}
 
         # Calculate absolute paths of directories to skip
-        self.skip_dirs = [os.path.realpath(os.path.join(self.directory, d)) for d in self.directories_to_skip]
+        self.skip_dirs = [os.path.realpath(os.path.join(self._root_realpath, d)) for d in self.directories_to_skip]
+        self.skip_dirs_set = set(self.skip_dirs)
+        self._skip_names = frozenset(self.directories_to_skip)
+
+        # Skip dirs as separator-terminated prefixes, precomputed for a single str.startswith
+        # call per check. Prefixes nested under another skip dir are redundant and dropped.
+        self._skip_prefixes = ()
+        # Memoized _dir_allowed verdicts, cleared with the gitignore cache at the start of each scan
+        self._dir_allowed_cache = {}
+        for prefix in sorted(d + os.sep for d in self.skip_dirs_set):
+            if not self._skip_prefixes or not prefix.startswith(self._skip_prefixes[-1]):
+                self._skip_prefixes += (prefix,)
 
         # Initialize the LangChain Chat model (using GPT-4o-mini)
         # try:
@@ -62,6 +346,9 @@ class RepositoryProcessor:
         """
         Returns the path relative to the root directory.
         """
+        # Walked paths are built from self.directory, so the common case needs no relpath
+        if path.startswith(self._dir_prefix):
+            return path[len(self._dir_prefix):]
         return os.path.relpath(path, self.directory)
 
     def count_tokens(self, file_path):
@@ -69,10 +356,10 @@ class RepositoryProcessor:
         Counts tokens in a text file using the specified encoding.
         """
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                text = f.read()
-                tokens = self.tokenizer_encoding.encode(text)
-                return len(tokens)
+            with open(file_path, "rb", buffering=READ_BUFFER) as f:
+                text = _translate_newlines(f.read()).decode("utf-8")
+            tokens = self.tokenizer_encoding.encode_ordinary(text)
+            return len(tokens)
         except UnicodeDecodeError as e:
             logging.error(f"Encoding error in file {file_path}: {e}")
             return 0
@@ -82,121 +369,328 @@ class RepositoryProcessor:
 
     def should_capture_file(self, file):
         """
-        Check if a file matches the capture rules.
+        Check if a file matches the capture rules. Files with a known binary extension are never captured.
         """
-        for file_type in self.file_types_to_capture:
-            match = file_type['match']
-            match_type = file_type['match_type']
-            if match_type == 'endswith' and file.endswith(match):
-                return True
-            elif match_type == 'equals' and file == match:
-                return True
-        return False
+        return self._capture_key(file) is not None
 
-    def generate_repo_metrics(self):
+    def _capture_key(self, file):
         """
-        Generates repository metrics for the output.
+        Returns the metrics key of a captured file (its extension, or its name if it has none),
+        or None if the file is not captured. The extension is computed once for both uses.
+        """
+        if not (file in self._exact_names or file.endswith(self._suffixes)):
+            return None
+        extension = os.path.splitext(file)[1]
+        if extension.lower() in BINARY_EXTS:
+            return None
+        return extension or file
+
+    def read_file_bytes(self, file_path):
+        """
+        Reads the bytes of a file with universal newlines applied.
+        Returns None if the file cannot be read.
+        """
+        try:
+            with open(file_path, "rb", buffering=READ_BUFFER) as f:
+                return _translate_newlines(f.read())
+        except Exception as e:
+            logging.error(f"Error reading file {file_path}: {e}")
+            return None
+
+    def _walk(self, path, real_path=None):
+        """
+        Recursively yields os.DirEntry objects for the files under path using os.scandir.
+        Mirrors os.walk: a directory's files are yielded before its subdirectories are
+        visited, and symlinked directories are never followed. Because of that, a
+        subdirectory's real path is its parent's real path plus its name, so realpath is
+        resolved only once, at the root. Ignored or skipped directories are rejected
+        before they are scanned, so their subtrees are never read.
         """
-        file_metrics = defaultdict(lambda: {"count": 0, "tokens": 0})
+        if real_path is None:
+            real_path = self._canonical(path)
+        # Directly under the root, a skip-listed name is the skip dir itself
+        skip_names = self._skip_names if real_path == self._root_realpath else ()
+        subdirs = []
+        try:
+            entries = self._listdir(path)
+        except OSError as e:
+            logging.error(f"Error scanning directory {path}: {e}")
+            return
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                yield entry
+            elif not entry.is_symlink():
+                subdirs.append(entry)
+        for entry in subdirs:
+            if entry.name in skip_names:
+                continue
+            sub_real_path = os.path.join(real_path, entry.name)
+            if not self.is_ignored(entry.path + os.sep) and self._dir_allowed(sub_real_path):
+                yield from self._walk(entry.path, sub_real_path)
+
+    def _listdir(self, path):
+        """
+        Returns the os.DirEntry objects of a directory, listing it only on first use.
+        DirEntry caches its type, so later passes over the same listing make no syscalls.
+        The cache is cleared at the start of each scan.
+        """
+        entries = self._dir_cache.get(path)
+        if entries is None:
+            with os.scandir(path) as it:
+                entries = self._dir_cache[path] = list(it)
+        return entries
+
+    def _read_and_encode(self, file_path):
+        """
+        Reads and tokenizes a single file. Runs on worker threads: file IO blocks
+        outside the GIL and tiktoken releases it while encoding.
+        See _read_and_encode_file for the returned tuple.
+        """
+        return _read_and_encode_file(file_path, self.tokenizer_encoding, self._token_cache)
+
+    def _process_count(self, file_count):
+        """
+        Returns the number of worker processes to tokenize with, or 0 to use threads.
+        """
+        if self.parallelism is None or file_count < PROCESS_POOL_MIN_FILES:
+            return 0
+        if self.parallelism == 'auto':
+            return os.cpu_count() or 1
+        return int(self.parallelism)
+
+    def _candidate_files(self):
+        """
+        Yields (entry, metrics_key, size) for every captured, non-ignored file, in walk order.
+        The size comes from the entry's stat, so empty and oversized files are never opened;
+        files larger than max_file_bytes are logged and left out. size is None if the file
+        cannot be stat'ed; such files are left to the reader, which logs the error.
+        """
+        for entry in self._walk(self.directory):
+            file_path = entry.path
+            if self.is_ignored(file_path):
+                continue
+            file_key = self._capture_key(entry.name)
+            if file_key is None:
+                continue
+            try:
+                size = entry.stat().st_size
+            except OSError:
+                size = None
+            if size is not None and self.max_file_bytes is not None and size > self.max_file_bytes:
+                logging.info(f"Skipping file larger than {self.max_file_bytes} bytes: {file_path}")
+                continue
+            yield entry, file_key, size
+
+    def _scan_repository(self):
+        """
+        Walks the repository once, reading every captured file a single time.
+        The bytes of each file are kept, up to max_cached_bytes, for writing the
+        combined document. Reading and tokenizing are spread across a thread or process pool.
+        """
+        ext_counts = Counter()
+        ext_tokens = Counter()
         total_files = 0
         total_tokens = 0
-        token_counts = {}
+        top_heap = []  # min-heap of (tokens, -walk_index, relative_path), at most 5 entries
+        all_files = []
+        candidate_files = []
+        candidate_keys = []
+        empty_files = set()
+        newline_files = set()
+        review_files = []
+        cached_bytes = 0
+        self._ignore_cache.clear()
+        self._dir_allowed_cache.clear()
+        self._dir_cache.clear()
 
         try:
-            for root, dirs, files in os.walk(self.directory):
-                # Normalize root path
-                root_realpath = os.path.realpath(root)
-                # Modify dirs in-place to skip directories based on their full paths
-                dirs[:] = [d for d in dirs if self.should_include_dir(os.path.join(root, d))]
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    if self.is_ignored(file_path):
-                        continue
-                    if self.should_capture_file(file):
-                        token_count = self.count_tokens(file_path)
-                        total_files += 1
-                        total_tokens += token_count
-                        file_extension = os.path.splitext(file)[-1] or file
-                        file_metrics[file_extension]["count"] += 1
-                        file_metrics[file_extension]["tokens"] += token_count
-                        token_counts[file_path] = token_count
+            for entry, file_key, size in self._candidate_files():
+                if size == 0:
+                    empty_files.add(len(candidate_files))
+                candidate_files.append(entry.path)
+                candidate_keys.append(file_key)
         except Exception as e:
             logging.error(f"Error generating repository metrics: {e}")
 
-        token_counts_rel = {self.get_relative_path(k): v for k, v in token_counts.items()}
-        top_files = sorted(token_counts_rel.items(), key=lambda item: item[1], reverse=True)[:5]
-        return total_files, total_tokens, file_metrics, top_files
+        read_files = [path for index, path in enumerate(candidate_files) if index not in empty_files]
+        processes = self._process_count(len(read_files))
+        if processes:
+            executor = ProcessPoolExecutor(max_workers=processes, initializer=_init_worker)
+            worker = _read_and_encode_in_worker
+        else:
+            executor = ThreadPoolExecutor(max_workers=min(32, os.cpu_count() or 1))
+            worker = self._read_and_encode
+        with executor:
+            read_results = executor.map(worker, read_files, chunksize=32)
+            # Empty files tokenize to 0, so their results are filled in without a read
+            results = (
+                (file_path, b"", 0, False) if index in empty_files else next(read_results)
+                for index, file_path in enumerate(candidate_files)
+            )
+            for index, (file_extension, (file_path, content, token_count, translated)) in enumerate(
+                    zip(candidate_keys, results)):
+                if token_count is None:
+                    continue
+                review_files.append(file_path)
+                relative_path = self.get_relative_path(file_path)
+                total_files += 1
+                total_tokens += token_count
+                ext_counts[file_extension] += 1
+                ext_tokens[file_extension] += token_count
+                # The walk index keeps ties in walk order, as a stable sort would
+                heap_item = (token_count, -index, relative_path)
+                if len(top_heap) < 5:
+                    heapq.heappush(top_heap, heap_item)
+                else:
+                    heapq.heappushpop(top_heap, heap_item)
+
+                # Files that could not be read or decoded were already logged by the worker
+                if content is None:
+                    continue
+                if cached_bytes + len(content) > self.max_cached_bytes:
+                    content = None
+                    if translated:
+                        newline_files.add(file_path)
+                else:
+                    cached_bytes += len(content)
+                all_files.append((file_path, relative_path, content, token_count))
+
+        # Counters keep first-seen order, so extensions are listed in walk order as before
+        file_metrics = {ext: {"count": count, "tokens": ext_tokens[ext]} for ext, count in ext_counts.items()}
+        top_files = [(relative_path, tokens) for tokens, _, relative_path in sorted(top_heap, reverse=True)]
+        return ScanResult(all_files, total_files, total_tokens, file_metrics, top_files,
+                          frozenset(newline_files), review_files)
+
+    def generate_repo_metrics(self):
+        """
+        Generates repository metrics for the output.
+        """
+        scan = self._scan_repository()
+        return scan.total_files, scan.total_tokens, scan.file_metrics, scan.top_files
 
     def generate_repo_structure(self):
         """
         Generates a tree-like textual representation of the repository structure.
+        Uses an explicit stack instead of recursion; the stack holds either finished
+        lines or (dir_path, dir_realpath, prefix) directories still to be expanded.
+        The tree is the last consumer of the directory listings, so they are dropped
+        once it is built and a later call lists the directories afresh.
         """
-        from pathlib import Path
-
         structure_lines = []
-
-        def tree(dir_path: Path, prefix: str = ''):
-            try:
-                contents = sorted([p for p in dir_path.iterdir()
-                                   if not self.is_ignored(str(p))
-                                   and self.should_include_dir(str(p))])
-            except PermissionError as e:
-                logging.error(f"Permission error accessing {dir_path}: {e}")
-                return
-            pointers = ['├── '] * (len(contents) - 1) + (['└── '] if contents else [])
-            for pointer, path in zip(pointers, contents):
-                yield prefix + pointer + path.name
-                if path.is_dir():
-                    extension = '│   ' if pointer == '├── ' else '    '
-                    yield from tree(path, prefix=prefix + extension)
-
         try:
-            root_path = Path(self.directory)
-            structure_lines = [line for line in tree(root_path)]
+            stack = [(self.directory, self._root_realpath, '')]
+            while stack:
+                item = stack.pop()
+                if isinstance(item, str):
+                    structure_lines.append(item)
+                    continue
+                dir_path, dir_realpath, prefix = item
+                try:
+                    entries = sorted(self._listdir(dir_path), key=lambda e: e.name)
+                except PermissionError as e:
+                    logging.error(f"Permission error accessing {dir_path}: {e}")
+                    continue
+                contents = []
+                # Directly under the root, a skip-listed name is the skip dir itself
+                # (symlinks are judged by their target below)
+                skip_names = self._skip_names if dir_realpath == self._root_realpath else ()
+                for entry in entries:
+                    if entry.name in skip_names and not entry.is_symlink():
+                        continue
+                    if self.is_ignored(entry.path + os.sep if entry.is_dir() else entry.path):
+                        continue
+                    if entry.is_symlink():
+                        entry_realpath = os.path.realpath(entry.path)
+                    else:
+                        entry_realpath = os.path.join(dir_realpath, entry.name)
+                    if self._dir_allowed(entry_realpath):
+                        contents.append((entry, entry_realpath))
+                items = []
+                for i, (entry, entry_realpath) in enumerate(contents):
+                    last = i == len(contents) - 1
+                    items.append(prefix + ('└── ' if last else '├── ') + entry.name)
+                    # Like Path.is_dir(), this follows symlinks so linked directories are expanded
+                    if entry.is_dir():
+                        items.append((entry.path, entry_realpath, prefix + ('    ' if last else '│   ')))
+                stack.extend(reversed(items))
             structure = '\n'.join(structure_lines)
         except Exception as e:
             logging.error(f"Error generating repository structure: {e}")
             structure = ''
+        finally:
+            self._dir_cache.clear()
         return structure
 
     def get_all_files(self):
         """
-        Retrieves a list of all files to be processed.
+        Retrieves a list of all files to be processed, leaving out oversized and binary files
+        exactly as the combined document does. Uses the files accepted by write_combined_docs
+        when it has run; otherwise lists the repository afresh, sniffing each non-empty file
+        for a NUL byte without reading or tokenizing the rest of it.
         """
-        all_files = []
-        for root, dirs, files in os.walk(self.directory):
-            root_realpath = os.path.realpath(root)
-            dirs[:] = [d for d in dirs if self.should_include_dir(os.path.join(root, d))]
-            for file in files:
-                file_path = os.path.join(root, file)
-                if not self.is_ignored(file_path) and self.should_capture_file(file):
-                    all_files.append(file_path)
-        return all_files
+        if self._review_files is not None:
+            return list(self._review_files)
+        self._ignore_cache.clear()
+        self._dir_allowed_cache.clear()
+        self._dir_cache.clear()
+        try:
+            return [
+                entry.path for entry, _, size in self._candidate_files()
+                if size == 0 or not _is_binary_file(entry.path)
+            ]
+        finally:
+            self._dir_cache.clear()
+
+    def _canonical(self, path):
+        """
+        Returns the real path of path, calling os.path.realpath only when path itself is a
+        symlink. Other paths under the processed directory are rebased onto its resolved root,
+        which is canonical as long as no intermediate directory is a symlink; traversal never
+        descends through symlinked directories, so that holds for every walked path.
+        """
+        if os.path.islink(path):
+            return os.path.realpath(path)
+        path = os.path.abspath(path)
+        if path == self.directory or path.startswith(self.directory + os.sep):
+            return self._root_realpath + path[len(self.directory):]
+        return path
+
+    def _dir_allowed(self, dir_realpath):
+        """
+        Memoized skip-directory verdict keyed by the directory's real path.
+        The cache is per instance and cleared at the start of each scan.
+        """
+        allowed = self._dir_allowed_cache.get(dir_realpath)
+        if allowed is None:
+            allowed = self._dir_allowed_cache[dir_realpath] = not (dir_realpath + os.sep).startswith(self._skip_prefixes)
+        return allowed
 
     def should_include_dir(self, dir_path, check_full_path=True):
         """
         Determines if a directory should be included.
         """
-        if self.is_ignored(dir_path):
+        if self.is_ignored(os.path.join(dir_path, '')):
             return False
-        dir_realpath = os.path.realpath(dir_path)
+        dir_realpath = self._canonical(dir_path)
         if check_full_path:
-            for skip_dir in self.skip_dirs:
-                if dir_realpath == skip_dir or dir_realpath.startswith(skip_dir + os.sep):
-                    return False
-        else:
-            if os.path.basename(dir_realpath) in self.directories_to_skip:
-                return False
+            return self._dir_allowed(dir_realpath)
+        if os.path.basename(dir_realpath) in self._skip_names:
+            return False
         return True
 
     def count_output_tokens(self):
         """
-        Counts tokens in the combined output file.
+        Counts tokens in the combined output file by re-tokenizing it.
+        Only used when write_combined_docs is asked to verify its running total.
         """
         try:
             with open(self.output_file, "r", encoding="utf-8") as f:
                 text = f.read()
-                tokens = self.tokenizer_encoding.encode(text)
+                tokens = self.tokenizer_encoding.encode_ordinary(text)
                 return len(tokens)
         except UnicodeDecodeError as e:
             logging.error(f"Encoding error in output file {self.output_file}: {e}")
@@ -210,7 +704,7 @@ class RepositoryProcessor:
         Converts a Jupyter Notebook (.ipynb) content into a plain Python (.py) script.
         """
         try:
-            nb = json.loads(content)
+            nb = _load_json(content)
             output_lines = []
             for i, cell in enumerate(nb.get("cells", [])):
                 cell_type = cell.get("cell_type")
@@ -236,99 +730,154 @@ class RepositoryProcessor:
             logging.error(f"Error converting ipynb to py: {e}")
             return content
 
-    def write_combined_docs(self):
+    def _copy_file_into(self, infile, size, outfile):
+        """
+        Copies the bytes of an open binary file of the given size straight into the
+        binary output stream. Uses os.sendfile so the copy stays in the kernel, falling
+        back to shutil.copyfileobj where sendfile is unavailable or unsupported.
+        """
+        offset = 0
+        if hasattr(os, 'sendfile'):
+            # Pending buffered output must reach the file before the kernel appends to it
+            outfile.flush()
+            try:
+                in_fd, out_fd = infile.fileno(), outfile.fileno()
+                remaining = size
+                while remaining > 0:
+                    sent = os.sendfile(out_fd, in_fd, offset, remaining)
+                    if sent == 0:
+                        break
+                    offset += sent
+                    remaining -= sent
+                return
+            except OSError:
+                # Nothing was sent if sendfile is unsupported here; copy from where it stopped
+                infile.seek(offset)
+        shutil.copyfileobj(infile, outfile, 1 << 20)
+
+    def _count_bytes_tokens(self, data):
+        """
+        Counts tokens in a UTF-8 encoded block of output.
+        """
+        try:
+            return len(self.tokenizer_encoding.encode_ordinary(data.decode('utf-8', errors='replace')))
+        except Exception as e:
+            logging.error(f"Error encoding tokens for output block: {e}")
+            return 0
+
+    def write_combined_docs(self, verify_output_tokens=False):
         """
         Generates the combined document of the repository files.
+        The output token total is accumulated while writing, from the static header counts,
+        the per-file counts of the scan, the tokens of each file path and the metrics and
+        structure blocks; no file content is tokenized twice. BPE merges can differ
+        slightly across block boundaries, so this is a close estimate; pass
+        verify_output_tokens=True to re-tokenize the finished file for an exact count.
         """
         try:
-            with open(self.output_file, 'w', encoding='utf-8') as outfile:
+            with open(self.output_file, 'wb', buffering=WRITE_BUFFER) as outfile:
+                # Scan the repository once for metrics and file contents
+                scan = self._scan_repository()
+                # Keep the scanned bytes for the knowledge base reviews so files are not read again
+                self._content_cache = {
+                    file_path: content for file_path, _, content, _ in scan.all_files if content is not None
+                }
+                self._review_files = scan.review_files
+                total_files, total_tokens, file_metrics, top_files = (
+                    scan.total_files, scan.total_tokens, scan.file_metrics, scan.top_files
+                )
                 # Write document introduction and metrics
-                total_files, total_tokens, file_metrics, top_files = self.generate_repo_metrics()
-                outfile.write("****** DOCUMENT INTRODUCTION ******\n\n")
-                outfile.write("This file is a merged representation of the entire codebase, combining all repository files into a single document.\n")
-                outfile.write("\n================================================================\n")
-                outfile.write("File Summary\n")
-                outfile.write("================================================================\n\n")
-                outfile.write("Purpose:\n--------\n")
-                outfile.write("This file contains a packed representation of the entire repository's contents.\n"
-                              "It is designed to be easily consumable by AI systems for analysis, code review,\n"
-                              "or other automated processes.\n\n")
-                outfile.write("File Format:\n------------\n")
-                outfile.write("The content is organized as follows:\n"
-                              "1. This summary section\n"
-                              "2. Repository metrics\n"
-                              "3. Repository structure\n"
-                              "4. Multiple file entries, each consisting of:\n"
-                              "  a. A separator line (================)\n"
-                              "  b. The file path (File: path/to/file)\n"
-                              "  c. Another separator line\n"
-                              "  d. The full contents of the file\n"
-                              "  e. A blank line\n\n")
-                outfile.write("\n================================================================\n")
-                outfile.write("Repository Metrics\n")
-                outfile.write("================================================================\n\n")
-                outfile.write(f"Total Files (Non-Ignored): {total_files}\n")
-                outfile.write(f"Total Tokens: {total_tokens}\n")
-                outfile.write("Total Files by Type:\n")
+                # Each section and each file entry is assembled first and written with one call
+                output_tokens = self._static_header_tokens
+                metrics_lines = [
+                    b"Total Files (Non-Ignored): %d\n" % total_files,
+                    b"Total Tokens: %d\n" % total_tokens,
+                    b"Total Files by Type:\n",
+                ]
                 for file_type, metrics in file_metrics.items():
-                    outfile.write(f"    - {file_type}: {metrics['count']} ({metrics['tokens']} tokens)\n")
-                outfile.write("\nTop 5 Files by Tokens:\n")
+                    metrics_lines.append(b"    - %s: %d (%d tokens)\n" % (os.fsencode(file_type), metrics['count'], metrics['tokens']))
+                metrics_lines.append(b"\nTop 5 Files by Tokens:\n")
                 for file_path, token_count in top_files:
-                    outfile.write(f"    - {file_path}: {token_count} tokens\n")
-                outfile.write("\n================================================================\n")
-                outfile.write("Repository Structure\n")
-                outfile.write("================================================================\n\n")
-                repo_structure = self.generate_repo_structure()
-                outfile.write(repo_structure)
-                outfile.write("\n")
-                outfile.write("\n================================================================\n")
-                outfile.write("Repository Files\n")
-                outfile.write("================================================================\n\n")
-                all_files = self.get_all_files()
-                for file_path in all_files:
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as infile:
-                            content = infile.read()
-                            if file_path.endswith('.ipynb'):
-                                content = self.convert_ipynb_to_py(content)
-                            relative_file_path = self.get_relative_path(file_path)
-                            outfile.write(f"================\nFile: {relative_file_path}\n================\n")
-                            outfile.write(content)
-                            outfile.write("\n\n")
-                    except UnicodeDecodeError as e:
-                        logging.error(f"Encoding error in file {file_path}: {e}")
-                    except Exception as e:
-                        logging.error(f"Error reading file {file_path}: {e}")
+                    metrics_lines.append(b"    - %s: %d tokens\n" % (os.fsencode(file_path), token_count))
+                metrics_block = b"".join(metrics_lines)
+                outfile.write(HEADER_INTRO + HEADER_METRICS + metrics_block)
+                output_tokens += self._count_bytes_tokens(metrics_block)
+                structure_block = self.generate_repo_structure().encode('utf-8') + b"\n"
+                outfile.write(HEADER_STRUCTURE + structure_block + HEADER_FILES)
+                output_tokens += self._count_bytes_tokens(structure_block)
+                for file_path, relative_file_path, content, token_count in scan.all_files:
+                    is_notebook = file_path.endswith('.ipynb')
+                    # Content beyond the in-memory budget is read again from disk; notebooks
+                    # need their text for conversion and files with translated newlines
+                    # cannot be copied as they are, everything else is copied by the kernel
+                    if content is None and (is_notebook or file_path in scan.newline_files):
+                        content = self.read_file_bytes(file_path)
+                        if content is None:
+                            continue
+                    if is_notebook:
+                        content = self.convert_ipynb_to_py(content.decode('utf-8')).encode('utf-8')
+                        token_count = self._count_bytes_tokens(content)
+                    relative_path_bytes = os.fsencode(relative_file_path)
+                    file_header = FILE_SEPARATOR + b"File: %s\n" % relative_path_bytes + FILE_SEPARATOR
+                    if content is None:
+                        # Open and size the file first, so an unreadable file leaves no header behind
+                        try:
+                            infile = open(file_path, 'rb')
+                        except OSError as e:
+                            logging.error(f"Error reading file {file_path}: {e}")
+                            continue
+                        with infile:
+                            try:
+                                size = os.fstat(infile.fileno()).st_size
+                            except OSError as e:
+                                logging.error(f"Error reading file {file_path}: {e}")
+                                continue
+                            outfile.write(file_header)
+                            try:
+                                self._copy_file_into(infile, size, outfile)
+                            except OSError as e:
+                                logging.error(f"Error copying file {file_path}: {e}")
+                            outfile.write(b"\n\n")
+                    else:
+                        outfile.write(b"".join((file_header, content, b"\n\n")))
+                    output_tokens += (self._file_header_tokens + self._count_bytes_tokens(relative_path_bytes)
+                                      + token_count + self._file_trailer_tokens)
             logging.info(f"Combined document generated successfully at {self.output_file}")
-            total_output_tokens = self.count_output_tokens()
+            total_output_tokens = self.count_output_tokens() if verify_output_tokens else output_tokens
             print(f"Total tokens in the output file '{self.output_file}': {total_output_tokens}")
             logging.info(f"Total tokens in the output file '{self.output_file}': {total_output_tokens}")
         except Exception as e:
             logging.critical(f"An unexpected error occurred while generating the combined document: {e}")
             sys.exit(1)
 
-    def read_file(self, file_path):
+    def read_file(self, file_path, max_bytes=None):
         """
-        Synchronously reads and returns the contents of a file.
+        Synchronously reads and returns the contents of a file, with universal newlines applied.
+        With max_bytes, only that many bytes are read and decoded.
         """
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return f.read()
+        with open(file_path, 'rb', buffering=READ_BUFFER) as f:
+            if max_bytes is None:
+                return _translate_newlines(f.read()).decode('utf-8')
+            return _decode_utf8_prefix(_translate_newlines(f.read(max_bytes)))
 
     async def gpt4o_mini_review(self, file_content):
         """
         Uses LangChain's OpenAI API integration to generate an overview of the file content.
-        Limits the content to the first 3000 characters (if needed) to avoid token overload.
+        The content is expected to be truncated already (see review_file).
         """
         if not self.llm:
             return "LLM not initialized."
         prompt = (
             "Please provide a concise overview of the following file content that will help an AI system "
             "determine its relevance to achieving its goals. Focus on summarizing the purpose and key details.\n\n"
-            f"{file_content[:3000]}"
+            f"{file_content}"
         )
+        if self._llm_semaphore is None:
+            self._llm_semaphore = asyncio.Semaphore(self.llm_concurrency)
         try:
-            # Asynchronously call the model
-            response = await self.llm.ainvoke(prompt)
+            # Asynchronously call the model; the semaphore keeps the request rate under control
+            async with self._llm_semaphore:
+                response = await self.llm.ainvoke(prompt)
             # Check if the response has a 'content' attribute and use it
             if hasattr(response, "content"):
                 description = response.content
@@ -342,18 +891,30 @@ class RepositoryProcessor:
     async def review_file(self, file_path):
         """
         Asynchronously reads and processes a file for review.
+        Uses the bytes kept from write_combined_docs when available.
         If the file is an ipynb, it converts it to a Python script format before review.
+        Only the first REVIEW_MAX_CHARS characters are reviewed, to avoid token overload;
+        other files are read only up to REVIEW_MAX_BYTES, which always holds that many.
         Returns a tuple (relative_file_path, description).
         """
+        # Notebooks are parsed as a whole, so they are read in full
+        max_bytes = None if file_path.endswith('.ipynb') else REVIEW_MAX_BYTES
         try:
-            content = await asyncio.to_thread(self.read_file, file_path)
+            cached = self._content_cache.get(file_path)
+            if cached is None:
+                loop = asyncio.get_running_loop()
+                content = await loop.run_in_executor(_READ_EXECUTOR, self.read_file, file_path, max_bytes)
+            elif max_bytes is None:
+                content = cached.decode('utf-8')
+            else:
+                content = _decode_utf8_prefix(cached[:max_bytes])
         except Exception as e:
             logging.error(f"Error reading file {file_path} asynchronously: {e}")
             return self.get_relative_path(file_path), "Error reading file."
 
         if file_path.endswith('.ipynb'):
             content = self.convert_ipynb_to_py(content)
-        description = await self.gpt4o_mini_review(content)
+        description = await self.gpt4o_mini_review(content[:REVIEW_MAX_CHARS])
         return self.get_relative_path(file_path), description
 
     async def build_knowledge_base_overview(self):
@@ -362,11 +923,16 @@ class RepositoryProcessor:
         of file names to overview descriptions.
         """
         overview = {}
+        # A fresh semaphore bound to this run's event loop
+        self._llm_semaphore = asyncio.Semaphore(self.llm_concurrency)
         files = self.get_all_files()
         tasks = [self.review_file(file_path) for file_path in files]
         results = await asyncio.gather(*tasks)
         for relative_path, desc in results:
             overview[relative_path] = desc
+        # The reviews were the last consumer of the scanned bytes and file list
+        self._content_cache = {}
+        self._review_files = None
 
         output_json = "combined-knowledge-base-overview.json"
         try: